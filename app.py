@@ -1,25 +1,183 @@
+import io
 import streamlit as st
 import pandas as pd
 import plotly.express as px
+import numpy as np
+from numba import njit, prange
+from pandas.api.types import union_categoricals
 from datetime import datetime, timedelta
 
 # --- Helper Functions ---
-def parse_shelf_life(text):
+def parse_shelf_life(texts):
     """
-    Parses the 'Minimum Shelf-life' text from the Excel sheet into an integer
-    representing months. Defaults to 6 months if the text is ambiguous or empty.
+    Parses the 'Minimum Shelf-life' texts from the Excel sheet into integers
+    representing months. Defaults to 6 months if a text is ambiguous or empty.
+    Works on the whole Series at once with vectorized string matching.
     """
-    if pd.isna(text) or not isinstance(text, str):
-        return 6  # Default to 6 months if NaN or not a string
-    text_lower = text.lower()
-    if "12 months" in text_lower or "1 year" in text_lower or "not less than 12 months" in text_lower:
-        return 12
-    elif "6 months" in text_lower:
-        return 6
-    elif "3 months" in text_lower:
-        return 3
-    else:
-        return 6  
+    texts_lower = texts.astype('string').str.lower()
+    months = np.select(
+        [
+            texts_lower.str.contains("12 months|1 year|not less than 12 months", regex=True, na=False),
+            texts_lower.str.contains("6 months", regex=False, na=False),
+            texts_lower.str.contains("3 months", regex=False, na=False)
+        ],
+        [12, 6, 3],
+        default=6  # Default to 6 months if NaN, not a string or no known pattern
+    )
+    return pd.Series(months, index=texts.index, dtype=np.int8)
+
+NAT_INT64 = np.iinfo(np.int64).min  # NaT as seen through a datetime64 int64 view
+NS_PER_DAY = 86_400_000_000_000
+
+@njit(cache=True)
+def civil_from_days(days):
+    """Converts days since 1970-01-01 to a (year, month, day) proleptic Gregorian date."""
+    z = days + 719468
+    era = z // 146097
+    doe = z - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + 3 if mp < 10 else mp - 9
+    year = yoe + era * 400 + (1 if month <= 2 else 0)
+    return year, month, day
+
+@njit(cache=True)
+def days_from_civil(year, month, day):
+    """Converts a proleptic Gregorian (year, month, day) to days since 1970-01-01."""
+    year -= 1 if month <= 2 else 0
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month - 3 if month > 2 else month + 9) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+@njit(cache=True)
+def days_in_month(year, month):
+    if month == 2:
+        return 29 if (year % 4 == 0 and year % 100 != 0) or year % 400 == 0 else 28
+    if month == 4 or month == 6 or month == 9 or month == 11:
+        return 30
+    return 31
+
+@njit(parallel=True, cache=True)
+def shift_months(epoch_ns, months, out):
+    """
+    Adds months[i] calendar months to each datetime64[ns] value (given as int64) into out,
+    clamping the day to the target month's last day like pd.DateOffset and keeping NaT.
+    Conversion, shift, clamp and time of day are fused in one parallel pass over the rows.
+    """
+    for i in prange(len(epoch_ns)):
+        value = epoch_ns[i]
+        if value == NAT_INT64:
+            out[i] = value
+            continue
+        days = value // NS_PER_DAY
+        time_of_day = value - days * NS_PER_DAY
+        year, month, day = civil_from_days(days)
+        total_months = year * 12 + (month - 1) + months[i]
+        new_year = total_months // 12
+        new_month = total_months - new_year * 12 + 1
+        new_day = min(day, days_in_month(new_year, new_month))
+        out[i] = days_from_civil(new_year, new_month, new_day) * NS_PER_DAY + time_of_day
+
+def add_months(dates, months):
+    """
+    Adds a per-row number of months to a datetime Series (calendar-exact, like
+    pd.DateOffset: Jan 31 + 1 month is Feb 28/29), through the shift_months kernel.
+    """
+    epoch_ns = dates.to_numpy(dtype='datetime64[ns]').view(np.int64)
+    shifted = np.empty_like(epoch_ns)
+    shift_months(epoch_ns, np.asarray(months, dtype=np.int64), shifted)
+    return pd.Series(shifted.view('datetime64[ns]'), index=dates.index, name=dates.name).astype(dates.dtype)
+
+# Display format for the date columns shown in st.dataframe
+DATE_COLUMN_CONFIG = {
+    'Forecast Ship Date': st.column_config.DateColumn(format='YYYY-MM-DD'),
+    'Expiration Date (Stock)': st.column_config.DateColumn(format='YYYY-MM-DD'),
+    'Required Expiration Date (Customer)': st.column_config.DateColumn(format='YYYY-MM-DD'),
+}
+
+# Metric "card" styling, shared by every st.metric in the app; injected once per run with the tab styles
+METRIC_CARD_CSS = """
+<style>
+/* Estilo geral para os containers das métricas (os "cards") */
+div[data-testid="stMetric"] {
+    background-color: white; /* Fundo branco para o card */
+    border-radius: 10px; /* Bordas arredondadas */
+    padding: 20px; /* Espaçamento interno */
+    box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1); /* Sombra suave para efeito de card */
+    margin-bottom: 20px; /* Espaçamento entre os cards e o conteúdo abaixo */
+}
+
+/* Estilo para o rótulo (label) da métrica */
+div[data-testid="stMetric"] label p {
+    font-family: Arial, sans-serif; /* Fonte do subtítulo da página principal */
+    color: #5d5d5d ; /* Cor cinza escuro para o rótulo */
+    font-weight: bold; /* Sem negrito */
+    font-size: 1em; /* Tamanho da fonte do rótulo */
+}
+
+/* Estilo para o valor (value) da métrica */
+div[data-testid="stMetric"] div[data-testid="stMetricValue"] {
+    font-family: Verdana, sans-serif; /* Fonte do título da página principal */
+    color: #a21a5e; /* Cor vinho para o valor */
+    font-size: 2.5em; /* Aumenta o tamanho do valor para destaque */
+    font-weight: bold; /* Deixa o valor em negrito */
+}
+
+/* Estilo para o delta (se houver um) na métrica */
+div[data-testid="stMetricDelta"] {
+    font-family: Arial, sans-serif; /* Fonte consistente */
+    color: #5d5d5d; /* Cor cinza escuro */
+    font-size: 1em; /* Tamanho padrão */
+}
+</style>
+"""
+
+# Status labels indexed by the integer codes emitted by simulate_stock_consumption
+IN_STOCK_STATUS_LABELS = ['Yes', 'No (Validity)', 'No (Quantity)', 'No (Quantity & Validity)']
+
+@njit(cache=True)
+def simulate_stock_consumption(group_ids, forecasted_qty, init_qty, is_stock_valid):
+    """
+    Simulates the sequential consumption of stock over the forecasted orders.
+    Orders must be sorted by product and then by forecast ship date; group_ids marks
+    which rows belong to the same product, init_qty holds that product's initial stock
+    on every row and is_stock_valid whether its expiry meets the order's shelf-life.
+    Returns the status code, missing quantity and remaining stock per order.
+    """
+    n = forecasted_qty.shape[0]
+    status_codes = np.empty(n, dtype=np.int8)
+    missing_qty = np.empty(n, dtype=np.float64)
+    remaining_qty = np.empty(n, dtype=np.float64)
+    current_available_qty = 0.0
+
+    for i in range(n):
+        if i == 0 or group_ids[i] != group_ids[i - 1]:
+            current_available_qty = init_qty[i]  # New product: start from its full stock
+        qty = forecasted_qty[i]
+
+        if current_available_qty >= qty:
+            if is_stock_valid[i]:
+                status_codes[i] = 0  # Yes
+                missing_qty[i] = 0
+                current_available_qty -= qty
+            else:
+                status_codes[i] = 1  # No (Validity)
+                missing_qty[i] = qty
+        else:
+            if is_stock_valid[i]:
+                status_codes[i] = 2  # No (Quantity)
+                missing_qty[i] = qty - current_available_qty
+            else:
+                status_codes[i] = 3  # No (Quantity & Validity)
+                missing_qty[i] = qty
+            current_available_qty = 0
+        remaining_qty[i] = current_available_qty
+
+    return status_codes, missing_qty, remaining_qty
 
 # Initialize session state variables if not already present
 if 'data_loaded' not in st.session_state:
@@ -28,15 +186,368 @@ if 'data_loaded' not in st.session_state:
     st.session_state.available_months = []
     st.session_state.available_customers = []
     st.session_state.available_medicines = []
+    st.session_state.hierarchical_sections = None  # (filter values, prepared sections) last shown in the Hierarchical View
 
-@st.cache_data
 def load_excel_data(source_file): # Modified to accept a source_file (path or uploaded file object)
-    """Loads data from the Excel file and caches it."""
-    stock_df = pd.read_excel(source_file, sheet_name="Stock On hand")
-    shipments_df = pd.read_excel(source_file, sheet_name="2024_Shipments")
-    shelf_life_df = pd.read_excel(source_file, sheet_name="shelf life")
+    """Loads data from the Excel file (cached through build_analysis)."""
+    # Open the workbook once and parse each sheet from it, reading only the columns the analysis uses.
+    # calamine (Rust) streams sheets much faster than openpyxl, which matters when a sheet carries
+    # formatting down to row 1,048,576 (as the shelf life sheet does).
+    # Text columns are pinned to the string dtype so pandas skips inferring them; dates and quantities are
+    # left to the converters in build_analysis because those columns can hold stray text cells
+    with pd.ExcelFile(source_file, engine="calamine") as workbook:
+        stock_df = workbook.parse("Stock On hand",
+                                  usecols=['Description', 'Available To Reserve', 'Expiration Date'],
+                                  dtype={'Description': 'string'})
+        shipments_df = workbook.parse("2024_Shipments",
+                                      usecols=['Ship Date', 'Item Description', 'Ship To Customer (Bill To)', 'Qty'],
+                                      dtype={'Item Description': 'string', 'Ship To Customer (Bill To)': 'string'})
+        shelf_life_df = workbook.parse("shelf life",
+                                       usecols=['Customer Name', 'Minimum Shelf-life (reported on customer PO)'],
+                                       dtype={'Customer Name': 'string', 'Minimum Shelf-life (reported on customer PO)': 'string'})
     return stock_df, shipments_df, shelf_life_df
 
+@st.cache_data(show_spinner=False)
+def build_analysis(file_bytes):
+    """
+    Runs the full stock vs. forecast analysis for an uploaded Excel file and caches
+    the result, keyed by the file's bytes, so widget reruns and re-uploads reuse it.
+    Returns the analysis DataFrame and the month/customer/item filter options.
+    """
+    stock_df, shipments_2024_df, shelf_life_df = load_excel_data(io.BytesIO(file_bytes))
+
+    # --- Start of Data Processing ---
+    # Low-cardinality keys become categoricals sharing one set of categories across the sheets, so the
+    # groupbys/merges below work on integer codes and the merges keep the categorical dtype
+    item_dtype = pd.CategoricalDtype(union_categoricals(
+        [pd.Categorical(shipments_2024_df['Item Description']), pd.Categorical(stock_df['Description'])],
+        sort_categories=True
+    ).categories)
+    customer_dtype = pd.CategoricalDtype(union_categoricals(
+        [pd.Categorical(shipments_2024_df['Ship To Customer (Bill To)']), pd.Categorical(shelf_life_df['Customer Name'])],
+        sort_categories=True
+    ).categories)
+    shipments_2024_df = shipments_2024_df.astype({'Item Description': item_dtype, 'Ship To Customer (Bill To)': customer_dtype})
+    stock_df['Description'] = stock_df['Description'].astype(item_dtype)
+    shelf_life_df['Customer Name'] = shelf_life_df['Customer Name'].astype(customer_dtype)
+
+    stock_df['Expiration Date'] = pd.to_datetime(stock_df['Expiration Date'], errors='coerce')
+    stock_df['Available To Reserve'] = pd.to_numeric(stock_df['Available To Reserve'], errors='coerce')  # Stray text cells would otherwise break the stock sum
+    stock_df = stock_df.rename(columns={'Description': 'Product Description', 'Available To Reserve': 'Available Stock Quantity'})
+
+    # Output order does not matter (the result is merged on Item Description), so skip the sort
+    consolidated_stock = stock_df.groupby('Product Description', sort=False, observed=True).agg(
+        total_available_stock=('Available Stock Quantity', 'sum'),
+        earliest_expiration_date=('Expiration Date', 'min')
+    ).reset_index()
+    consolidated_stock = consolidated_stock.rename(columns={'Product Description': 'Item Description'})
+
+    shelf_life_df['Min Shelf-Life (Months)'] = parse_shelf_life(shelf_life_df['Minimum Shelf-life (reported on customer PO)'])
+    shelf_life_df = shelf_life_df.rename(columns={'Customer Name': 'Ship To Customer (Bill To)'})
+    shelf_life_df = shelf_life_df.drop(columns=['Minimum Shelf-life (reported on customer PO)'])
+
+    shipments_2024_df['Ship Date'] = pd.to_datetime(shipments_2024_df['Ship Date'], errors='coerce')
+    shipments_2024_df['Qty'] = pd.to_numeric(shipments_2024_df['Qty'], errors='coerce')  # Stray text cells would otherwise make the column object
+    shipments_2024_df = shipments_2024_df.dropna(subset=['Ship Date'])
+
+    ship_months = shipments_2024_df['Ship Date'].dt.month.to_numpy()  # Extract the month once for both bounds
+    shipments_2024_filtered = shipments_2024_df[(ship_months >= 6) & (ship_months <= 12)]
+
+    # Monthly rollup per (item, customer, ship month) without a hashed groupby: the three integer keys
+    # (category codes and the month's period ordinal) are packed into one int64, sorted once, and each
+    # run of equal keys is summed with np.add.reduceat.
+    # The packed order is item, then customer, then month, same as groupby(sort=True); the stable sort
+    # below keeps that customer order as the consumption order for same-month orders
+    ship_dates = shipments_2024_filtered['Ship Date']
+    item_codes = shipments_2024_filtered['Item Description'].cat.codes.to_numpy(dtype=np.int64)
+    customer_codes = shipments_2024_filtered['Ship To Customer (Bill To)'].cat.codes.to_numpy(dtype=np.int64)
+    month_ordinals = ((ship_dates.dt.year - 1970) * 12 + ship_dates.dt.month - 1).to_numpy(dtype=np.int64)
+    has_keys = (item_codes >= 0) & (customer_codes >= 0)  # Rows without an item or customer are dropped, as groupby does
+    item_codes, customer_codes, month_ordinals = item_codes[has_keys], customer_codes[has_keys], month_ordinals[has_keys]
+    qty = shipments_2024_filtered['Qty'].fillna(0).to_numpy()[has_keys]  # Missing quantities add nothing, as in sum()
+
+    first_month = month_ordinals.min() if len(month_ordinals) else 0
+    n_months = month_ordinals.max() - first_month + 1 if len(month_ordinals) else 1
+    group_keys = (item_codes * len(customer_dtype.categories) + customer_codes) * n_months + (month_ordinals - first_month)
+    order = np.argsort(group_keys, kind='stable')
+    sorted_keys = group_keys[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]) if len(sorted_keys) else np.empty(0, dtype=np.intp)
+    first_rows = order[group_starts]
+
+    forecast_2025_df = pd.DataFrame({
+        'Item Description': pd.Categorical.from_codes(item_codes[first_rows], dtype=item_dtype),
+        'Ship To Customer (Bill To)': pd.Categorical.from_codes(customer_codes[first_rows], dtype=customer_dtype),
+        'Ship Month': pd.PeriodIndex.from_ordinals(month_ordinals[first_rows], freq='M'),
+        'Qty': np.add.reduceat(qty[order], group_starts)
+    })
+
+    # Same month, moved to 2025; built from date components in one vectorized call
+    forecast_2025_df['Forecast Ship Date'] = pd.to_datetime(pd.DataFrame({
+        'year': 2025,
+        'month': forecast_2025_df['Ship Month'].dt.month,
+        'day': 1
+    }))
+    forecast_2025_df['Forecast Month'] = forecast_2025_df['Forecast Ship Date'].dt.to_period('M')  # Reused by the monthly chart
+    forecast_2025_df = forecast_2025_df.rename(columns={'Qty': 'Forecasted Qty'})
+
+    # The shelf life sheet is a small customer -> months lookup, so resolve it once per customer category
+    # and take by the categorical codes instead of merging; customers not on the sheet default to 6 months
+    shelf_life_map = dict(zip(shelf_life_df['Ship To Customer (Bill To)'], shelf_life_df['Min Shelf-Life (Months)']))
+    shelf_life_by_customer = customer_dtype.categories.map(shelf_life_map).fillna(6).to_numpy(dtype=np.int8)
+    forecasted_orders_with_shelf_life = forecast_2025_df.assign(**{
+        'Min Shelf-Life (Months)': shelf_life_by_customer[forecast_2025_df['Ship To Customer (Bill To)'].cat.codes.to_numpy()]
+    })
+    forecasted_orders_with_shelf_life['Required Expiration Date (Customer)'] = add_months(
+        forecasted_orders_with_shelf_life['Forecast Ship Date'],
+        forecasted_orders_with_shelf_life['Min Shelf-Life (Months)']
+    )
+
+    # Join each order with its product's initial stock once, instead of looking it up per product
+    forecasted_orders_with_stock = pd.merge(
+        forecasted_orders_with_shelf_life,
+        consolidated_stock.rename(columns={
+            'total_available_stock': 'Available Stock Quantity (Initial)',
+            'earliest_expiration_date': 'Expiration Date (Stock)'
+        }),
+        on='Item Description',
+        how='left'
+    )
+    # Products without stock come out of the left join as NaN; fill them and restore the stock dtype
+    forecasted_orders_with_stock['Available Stock Quantity (Initial)'] = forecasted_orders_with_stock['Available Stock Quantity (Initial)'].fillna(0).astype(
+        consolidated_stock['total_available_stock'].dtype
+    )
+
+    # Sort once by product and ship date so the simulation can walk every order in a single pass
+    orders_sorted = forecasted_orders_with_stock.sort_values(by=['Item Description', 'Forecast Ship Date'], kind='stable')
+    group_ids, _ = pd.factorize(orders_sorted['Item Description'])
+    forecasted_qty = orders_sorted['Forecasted Qty'].to_numpy(dtype=np.float64)
+    init_qty = orders_sorted['Available Stock Quantity (Initial)'].to_numpy(dtype=np.float64)
+    # Validity does not depend on the running stock, so it is one vectorized comparison (NaT compares False)
+    is_stock_valid = (orders_sorted['Expiration Date (Stock)'] >= orders_sorted['Required Expiration Date (Customer)']).to_numpy(dtype=np.bool_)
+
+    # A product with no stock and only positive orders never changes state: every order is fully
+    # missing and the stock stays at 0, so resolve those products directly and only simulate the rest
+    min_qty_per_product = orders_sorted.groupby('Item Description', sort=False, observed=True)['Forecasted Qty'].transform('min').to_numpy()
+    needs_simulation = (init_qty != 0) | (min_qty_per_product <= 0)
+
+    status_codes = np.where(is_stock_valid, 2, 3).astype(np.int8)  # No (Quantity) / No (Quantity & Validity)
+    missing_qty = forecasted_qty.copy()
+    remaining_qty = np.zeros(len(orders_sorted), dtype=np.float64)
+    simulated = simulate_stock_consumption(
+        group_ids[needs_simulation].astype(np.int64),
+        forecasted_qty[needs_simulation],
+        init_qty[needs_simulation],
+        is_stock_valid[needs_simulation]
+    )
+    status_codes[needs_simulation], missing_qty[needs_simulation], remaining_qty[needs_simulation] = simulated
+
+    final_analysis_df_sequential = orders_sorted.assign(**{
+        'In Stock Status': pd.Categorical.from_codes(status_codes, categories=IN_STOCK_STATUS_LABELS),
+        'Missing Quantity': missing_qty,
+        'Remaining Stock After Order': remaining_qty
+    })
+    # --- End of Data Processing ---
+
+    # Filter options for the tabs, computed here so they are cached along with the analysis
+    # Months are kept as Periods: filtering compares them directly and str() renders them as YYYY-MM
+    available_months = sorted(final_analysis_df_sequential['Forecast Month'].unique())
+    available_customers = sorted(final_analysis_df_sequential['Ship To Customer (Bill To)'].unique())
+    available_medicines = sorted(final_analysis_df_sequential['Item Description'].unique())
+    return final_analysis_df_sequential, available_months, available_customers, available_medicines
+
+def filter_analysis(df, selected_month, selected_customer, selected_item):
+    """
+    Applies the month/customer/item filters shared by all tabs ('All' means no filter).
+    A single boolean mask, so the full analysis frame is never copied just to be filtered.
+    """
+    mask = np.ones(len(df), dtype=bool)
+    if selected_month != 'All':
+        mask &= (df['Forecast Month'] == selected_month).to_numpy()
+    if selected_customer != 'All':
+        mask &= (df['Ship To Customer (Bill To)'] == selected_customer).to_numpy()
+    if selected_item != 'All':
+        mask &= (df['Item Description'] == selected_item).to_numpy()
+    return df[mask]
+
+# Columns of the per-product orders table in the hierarchical view
+HIERARCHICAL_ORDER_COLUMNS = [
+    'Ship To Customer (Bill To)',
+    'Forecast Ship Date',
+    'Forecasted Qty',
+    'Available Stock Quantity (Initial)',
+    'Remaining Stock After Order',
+    'Expiration Date (Stock)',
+    'Required Expiration Date (Customer)',
+    'In Stock Status',
+    'Missing Quantity'
+]
+
+# Most order rows shown per product in the hierarchical view; totals and summaries still cover every row
+HIERARCHICAL_MAX_ROWS = 500
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def prepare_hierarchical(filtered_df):
+    """
+    Builds everything the hierarchical view renders for the filtered orders: one entry per
+    product with its expander label, customer summary, orders table (first HIERARCHICAL_MAX_ROWS
+    rows) and total order count. Cached on the filtered rows, so reruns that don't change the
+    hierarchical filters skip the groupbys and sorts.
+    """
+    # Only the columns the view shows are carried along; Required Expiration Date comes precomputed from build_analysis
+    filtered_df = filtered_df[['Item Description', 'Min Shelf-Life (Months)', *HIERARCHICAL_ORDER_COLUMNS]]
+
+    # All the per-product figures come from single passes over the filtered frame: product totals and
+    # (product, customer) summaries from one groupby each, and the orders from one sort, split by product
+    product_totals = filtered_df.groupby('Item Description', sort=False, observed=True)[['Forecasted Qty', 'Missing Quantity']].sum()
+    customer_summaries = filtered_df.groupby(['Item Description', 'Ship To Customer (Bill To)'], sort=False, observed=True).agg({
+        'Min Shelf-Life (Months)': 'first',
+        'Forecasted Qty': 'sum',
+        'Missing Quantity': 'sum'
+    })
+    # Split the summaries by product in one pass over the index (a .loc per product would rescan the
+    # unsorted MultiIndex every time); customers keep their first-appearance order within each product
+    customer_summary_by_product = {
+        product: product_summary.droplevel('Item Description')
+        for product, product_summary in customer_summaries.groupby(level='Item Description', sort=False, observed=True)
+    }
+    # Project the table columns once on the sorted orders; each product's rows are then one contiguous slice
+    sorted_orders = filtered_df.sort_values(['Item Description', 'Ship To Customer (Bill To)', 'Forecast Ship Date'], kind='stable')
+    orders_view = sorted_orders[HIERARCHICAL_ORDER_COLUMNS]
+    item_codes = sorted_orders['Item Description'].cat.codes.to_numpy()
+    product_starts = np.flatnonzero(np.r_[True, item_codes[1:] != item_codes[:-1]])
+    product_stops = np.r_[product_starts[1:], len(item_codes)]
+
+    # Expander labels are formatted here too, so they are built once per filter combination, not per rerun
+    product_labels = {
+        product: f"**Product:** {product} (Total Forecasted: {total_forecasted:,.0f} | Missing: {total_missing:,.0f})"
+        for product, total_forecasted, total_missing in zip(
+            product_totals.index, product_totals['Forecasted Qty'], product_totals['Missing Quantity']
+        )
+    }
+
+    sections = []
+    for product, start, stop in zip(sorted_orders['Item Description'].iloc[product_starts], product_starts, product_stops):
+        # One summary row per customer plus one orders table per product, rather than a table per customer
+        sections.append((
+            product,
+            product_labels[product],
+            customer_summary_by_product[product],
+            orders_view.iloc[start:min(stop, start + HIERARCHICAL_MAX_ROWS)],
+            stop - start
+        ))
+    return sections
+
+@st.cache_data(show_spinner=False)
+def make_monthly_bar(monthly_forecast):
+    """Builds the monthly forecasted orders bar chart; cached on the small aggregated input."""
+    fig_px_bar = px.bar(
+        monthly_forecast,
+        x='Month',
+        y='Forecasted Qty'
+    )
+    fig_px_bar.update_traces(marker_color='#c7c8c9')
+    fig_px_bar.update_layout(
+        hoverlabel=dict(
+            bgcolor="#a21a5e", 
+            font_size=12,
+            font_color="#ffffff",
+            font_family="Arial, sans-serif" 
+        ),
+        plot_bgcolor='rgba(0,0,0,0)', 
+        paper_bgcolor='rgba(0,0,0,0)', 
+    )
+    return fig_px_bar
+
+@st.cache_data(show_spinner=False)
+def make_sufficiency_pie(total_covered_qty, total_missing_qty):
+    """Builds the covered vs. missing quantity pie chart; cached on the two totals."""
+    pie_data_chart = pd.DataFrame({
+        'Category': ['Quantity Covered', 'Quantity Missing'],
+        'Quantity': [total_covered_qty, total_missing_qty]
+    })
+    fig_pie = px.pie(
+        pie_data_chart,
+        values='Quantity',
+        names='Category',
+        color='Category',
+        color_discrete_map={
+            'Quantity Covered': '#a21a5e',
+            'Quantity Missing': '#c7c8c9'
+        }
+    )
+    fig_pie.update_traces(
+        sort=False,
+        textposition='inside',
+        textinfo='percent+label',
+    )
+    fig_pie.update_layout(
+        plot_bgcolor='rgba(0,0,0,0)',
+        paper_bgcolor='rgba(0,0,0,0)',
+        hoverlabel=dict(
+            bgcolor="#a21a5e",
+            font_size=12,
+            font_color="white",
+            font_family="Verdana, Geneva, sans-serif"
+        ),
+        showlegend=True,
+        legend_title_text='Status',
+        legend=dict(
+            orientation="h",
+            yanchor="bottom",
+            y=1.02,
+            xanchor="right",
+            x=1
+        )
+    )
+    return fig_pie
+
+@st.fragment
+def render_hierarchical_view(final_analysis_df_sequential, available_months, available_customers, available_medicines):
+    """
+    Filters and drill-down of the Hierarchical View. Runs as a fragment, so changing its
+    filters or opening a product only reruns this view, not the whole app.
+    """
+    # --- Filters for Hierarchical View ---
+    col_filter1_hier, col_filter2_hier, col_filter3_hier = st.columns(3)
+    with col_filter1_hier:
+        selected_month_hier = st.selectbox("Month (YYYY-MM):", options=['All'] + available_months, format_func=str, key='month_hier')
+    with col_filter2_hier:
+        selected_customer_hier = st.selectbox("Customer:", options=['All'] + available_customers, key='customer_hier')
+    with col_filter3_hier:
+        selected_medicine_hier = st.selectbox("Item:", options=['All'] + available_medicines, key='medicine_hier')
+
+    # Reuse the sections prepared for the same filters earlier in this session: reruns triggered
+    # elsewhere then skip filtering and hashing the frame for prepare_hierarchical's cache lookup
+    filter_key = (selected_month_hier, selected_customer_hier, selected_medicine_hier)
+    last_sections = st.session_state.get('hierarchical_sections')
+    if last_sections is not None and last_sections[0] == filter_key:
+        sections = last_sections[1]
+    else:
+        filtered_data_hierarchical = filter_analysis(
+            final_analysis_df_sequential, selected_month_hier, selected_customer_hier, selected_medicine_hier
+        )
+        sections = prepare_hierarchical(filtered_data_hierarchical) if not filtered_data_hierarchical.empty else []
+        st.session_state.hierarchical_sections = (filter_key, sections)
+
+    if sections:
+        for product, product_label, customer_summary, product_orders, product_order_count in sections:
+            # The expander tracks its open state, so the tables are only built and sent for open products
+            product_expander = st.expander(
+                product_label,
+                key=f"hier_expander_{product}",
+                on_change="rerun"
+            )
+            with product_expander:
+                if product_expander.open:
+                    st.markdown(f"**Customer Details for {product}:**")
+                    st.dataframe(customer_summary, use_container_width=True)
+                    # Dates stay datetime64 and are formatted by the grid (as in the matrix), so no strings are built per rerun
+                    st.dataframe(product_orders, column_config=DATE_COLUMN_CONFIG, hide_index=True, use_container_width=True)
+                    if product_order_count > len(product_orders):
+                        st.caption(f"Showing first {len(product_orders):,} of {product_order_count:,} orders")
+    else:
+        st.info("No data to display for the selected filters in the Hierarchical View.")
+
 st.set_page_config(layout="wide", page_title="Stock & Sales Forecasting")
 
 # --- Main application logic: Conditional display of uploader or tabs ---
@@ -50,103 +561,12 @@ if not st.session_state.data_loaded:
 
     if uploaded_file is not None:
         try:
-            stock_df, shipments_2024_df, shelf_life_df = load_excel_data(uploaded_file)
             # Removed: st.success("Excel data loaded successfully!") - will be hidden by rerun
-
-            # --- Start of Data Processing ---
-            stock_df['Expiration Date'] = pd.to_datetime(stock_df['Expiration Date'], errors='coerce')
-            stock_df = stock_df.rename(columns={'Description': 'Product Description', 'Available To Reserve': 'Available Stock Quantity'})
-
-            consolidated_stock = stock_df.groupby('Product Description').agg(
-                total_available_stock=('Available Stock Quantity', 'sum'),
-                earliest_expiration_date=('Expiration Date', 'min')
-            ).reset_index()
-            consolidated_stock = consolidated_stock.rename(columns={'Product Description': 'Item Description'})
-
-            shelf_life_df['Min Shelf-Life (Months)'] = shelf_life_df['Minimum Shelf-life (reported on customer PO)'].apply(parse_shelf_life)
-            shelf_life_df = shelf_life_df.rename(columns={'Customer Name': 'Ship To Customer (Bill To)'})
-            shelf_life_df = shelf_life_df.drop(columns=['Minimum Shelf-life (reported on customer PO)'])
-
-            shipments_2024_df['Ship Date'] = pd.to_datetime(shipments_2024_df['Ship Date'], errors='coerce')
-            shipments_2024_df = shipments_2024_df.dropna(subset=['Ship Date'])
-
-            shipments_2024_filtered = shipments_2024_df[
-                (shipments_2024_df['Ship Date'].dt.month >= 6) &
-                (shipments_2024_df['Ship Date'].dt.month <= 12)
-            ].copy()
-
-            forecast_2025_df = shipments_2024_filtered.groupby([
-                'Item Description',
-                'Ship To Customer (Bill To)',
-                shipments_2024_filtered['Ship Date'].dt.to_period('M')
-            ])['Qty'].sum().reset_index()
-
-            forecast_2025_df['Forecast Ship Date'] = forecast_2025_df['Ship Date'].dt.start_time.apply(lambda x: x.replace(year=2025))
-            forecast_2025_df = forecast_2025_df.rename(columns={'Qty': 'Forecasted Qty'})
-
-            forecasted_orders_with_shelf_life = pd.merge(
-                forecast_2025_df,
-                shelf_life_df,
-                on='Ship To Customer (Bill To)',
-                how='left'
-            )
-            forecasted_orders_with_shelf_life['Min Shelf-Life (Months)'] = forecasted_orders_with_shelf_life['Min Shelf-Life (Months)'].fillna(6)
-
-            sequential_analysis_results = []
-            for product_name, product_group_df in forecasted_orders_with_shelf_life.groupby('Item Description'):
-                initial_stock_info = consolidated_stock[consolidated_stock['Item Description'] == product_name]
-                current_available_qty = initial_stock_info['total_available_stock'].iloc[0] if not initial_stock_info.empty else 0
-                stock_expiration_date = initial_stock_info['earliest_expiration_date'].iloc[0] if not initial_stock_info.empty else pd.NaT
-                product_group_df_sorted = product_group_df.sort_values(by='Forecast Ship Date')
-
-                for index, row in product_group_df_sorted.iterrows():
-                    forecasted_qty = row['Forecasted Qty']
-                    forecast_ship_date = row['Forecast Ship Date']
-                    min_shelf_life_months = row['Min Shelf-Life (Months)']
-                    required_expiration_date = forecast_ship_date + pd.DateOffset(months=min_shelf_life_months)
-                    in_stock_status = "No"
-                    missing_qty = forecasted_qty
-                    is_stock_valid_for_order = pd.notna(stock_expiration_date) and stock_expiration_date >= required_expiration_date
-
-                    if current_available_qty >= forecasted_qty:
-                        if is_stock_valid_for_order:
-                            in_stock_status = "Yes"
-                            missing_qty = 0
-                            current_available_qty -= forecasted_qty
-                        else:
-                            in_stock_status = "No (Validity)"
-                    else:
-                        if is_stock_valid_for_order:
-                            in_stock_status = "No (Quantity)"
-                            missing_qty = forecasted_qty - current_available_qty
-                            current_available_qty = 0
-                        else:
-                            in_stock_status = "No (Quantity & Validity)"
-                            missing_qty = forecasted_qty
-                            current_available_qty = 0
-                    
-                    row_result = row.copy()
-                    row_result['Available Stock Quantity (Initial)'] = initial_stock_info['total_available_stock'].iloc[0] if not initial_stock_info.empty else 0
-                    row_result['Expiration Date (Stock)'] = stock_expiration_date
-                    row_result['In Stock Status'] = in_stock_status
-                    row_result['Missing Quantity'] = missing_qty
-                    row_result['Remaining Stock After Order'] = current_available_qty
-                    sequential_analysis_results.append(row_result)
-            
-            final_analysis_df_sequential = pd.DataFrame(sequential_analysis_results)
-            # --- End of Data Processing ---
-
-            # Store processed data in session state
-            st.session_state.final_analysis_df = final_analysis_df_sequential
-            if not final_analysis_df_sequential.empty:
-                st.session_state.available_months = sorted(final_analysis_df_sequential['Forecast Ship Date'].dt.strftime('%Y-%m').unique())
-                st.session_state.available_customers = sorted(final_analysis_df_sequential['Ship To Customer (Bill To)'].unique())
-                st.session_state.available_medicines = sorted(final_analysis_df_sequential['Item Description'].unique())
-            else:
-                st.session_state.available_months = []
-                st.session_state.available_customers = []
-                st.session_state.available_medicines = []
-            
+            (st.session_state.final_analysis_df,
+             st.session_state.available_months,
+             st.session_state.available_customers,
+             st.session_state.available_medicines) = build_analysis(uploaded_file.getvalue())
+            st.session_state.hierarchical_sections = None  # Sections were prepared from the previous file
             st.session_state.data_loaded = True
             st.rerun()
 
@@ -211,6 +631,7 @@ else: # This means st.session_state.data_loaded is True. Display the tabs.
             """,
             unsafe_allow_html=True
         )
+        st.markdown(METRIC_CARD_CSS, unsafe_allow_html=True)
         col_logo, col_title = st.columns([0.2, 0.8]) 
 
         with col_logo:
@@ -269,27 +690,19 @@ else: # This means st.session_state.data_loaded is True. Display the tabs.
             # --- Filters for Detailed Matrix ---
             col_filter1_matrix, col_filter2_matrix, col_filter3_matrix = st.columns(3)
             with col_filter1_matrix:
-                selected_month_matrix = st.selectbox("Month (YYYY-MM):", options=['All'] + available_months, key='month_matrix')
+                selected_month_matrix = st.selectbox("Month (YYYY-MM):", options=['All'] + available_months, format_func=str, key='month_matrix')
             with col_filter2_matrix:
                 selected_customer_matrix = st.selectbox("Customer:", options=['All'] + available_customers, key='customer_matrix')
             with col_filter3_matrix:
                 selected_medicine_matrix = st.selectbox("Item:", options=['All'] + available_medicines, key='medicine_matrix')
 
             # Filter data for the matrix
-            filtered_data_matrix = final_analysis_df_sequential.copy()
-            if selected_month_matrix != 'All':
-                filtered_data_matrix = filtered_data_matrix[filtered_data_matrix['Forecast Ship Date'].dt.strftime('%Y-%m') == selected_month_matrix]
-            if selected_customer_matrix != 'All':
-                filtered_data_matrix = filtered_data_matrix[filtered_data_matrix['Ship To Customer (Bill To)'] == selected_customer_matrix]
-            if selected_medicine_matrix != 'All':
-                filtered_data_matrix = filtered_data_matrix[filtered_data_matrix['Item Description'] == selected_medicine_matrix]
+            filtered_data_matrix = filter_analysis(
+                final_analysis_df_sequential, selected_month_matrix, selected_customer_matrix, selected_medicine_matrix
+            )
 
 
             if not filtered_data_matrix.empty:
-                filtered_data_matrix['Required Expiration Date (Customer)'] = filtered_data_matrix.apply(
-                    lambda row: row['Forecast Ship Date'] + pd.DateOffset(months=row['Min Shelf-Life (Months)']), axis=1
-                )
-
                 display_columns = [
                     'Item Description',
                     'Forecast Ship Date',
@@ -304,87 +717,37 @@ else: # This means st.session_state.data_loaded is True. Display the tabs.
                     'Missing Quantity'
                 ]
                 
-                final_matrix_display = filtered_data_matrix[display_columns].copy()
-                
-                final_matrix_display['Forecast Ship Date'] = final_matrix_display['Forecast Ship Date'].dt.strftime('%Y-%m-%d')
-                final_matrix_display['Expiration Date (Stock)'] = final_matrix_display['Expiration Date (Stock)'].dt.strftime('%Y-%m-%d').replace({pd.NaT: 'N/A'})
-                final_matrix_display['Required Expiration Date (Customer)'] = final_matrix_display['Required Expiration Date (Customer)'].dt.strftime('%Y-%m-%d')
-
-                st.dataframe(final_matrix_display, use_container_width=True)
+                # Dates stay datetime64; the grid formats them, so no string columns are built per rerun
+                st.dataframe(
+                    filtered_data_matrix[display_columns],
+                    column_config=DATE_COLUMN_CONFIG,
+                    use_container_width=True
+                )
             else:
                 st.info("No data to display for the selected filters in the Detailed Matrix.")
 
 
-            
-            total_forecasted_qty = final_analysis_df_sequential['Forecasted Qty'].sum() # This remains global for context or should be filtered too?
-            total_missing_qty_overall = final_analysis_df_sequential['Missing Quantity'].sum() # This remains global for context
-            
-            # KPIs below the matrix could also be filtered or show overall. For now, they are overall.
-            # If they need to be filtered, use filtered_data_matrix for these calculations.
-
-            st.markdown(
-                """
-                <style>
-                /* Estilo geral para os containers das métricas (os "cards") */
-                div[data-testid="stMetric"] {
-                    background-color: white; /* Fundo branco para o card */
-                    border-radius: 10px; /* Bordas arredondadas */
-                    padding: 20px; /* Espaçamento interno */
-                    box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1); /* Sombra suave para efeito de card */
-                    margin-bottom: 20px; /* Espaçamento entre os cards e o conteúdo abaixo */
-                }
-
-                /* Estilo para o rótulo (label) da métrica */
-                div[data-testid="stMetric"] label p {
-                    font-family: Arial, sans-serif; /* Fonte do subtítulo da página principal */
-                    color: #5d5d5d ; /* Cor cinza escuro para o rótulo */
-                    font-weight: bold; /* Sem negrito */
-                    font-size: 1em; /* Tamanho da fonte do rótulo */
-                }
-
-                /* Estilo para o valor (value) da métrica */
-                div[data-testid="stMetric"] div[data-testid="stMetricValue"] {
-                    font-family: Verdana, sans-serif; /* Fonte do título da página principal */
-                    color: #a21a5e; /* Cor vinho para o valor */
-                    font-size: 2.5em; /* Aumenta o tamanho do valor para destaque */
-                    font-weight: bold; /* Deixa o valor em negrito */
-                }
-
-                /* Estilo para o delta (se houver um) na métrica */
-                div[data-testid="stMetricDelta"] {
-                    font-family: Arial, sans-serif; /* Fonte consistente */
-                    color: #5d5d5d; /* Cor cinza escuro */
-                    font-size: 1em; /* Tamanho padrão */
-                }
-                </style>
-                """,
-                unsafe_allow_html=True
-            )
         with tab_kpis_charts:
             # --- Filters for KPIs & Charts ---
             col_filter1_kpi, col_filter2_kpi, col_filter3_kpi = st.columns(3)
             with col_filter1_kpi:
-                selected_month_kpi = st.selectbox("Month (YYYY-MM):", options=['All'] + available_months, key='month_kpi')
+                selected_month_kpi = st.selectbox("Month (YYYY-MM):", options=['All'] + available_months, format_func=str, key='month_kpi')
             with col_filter2_kpi:
                 selected_customer_kpi = st.selectbox("Customer:", options=['All'] + available_customers, key='customer_kpi')
             with col_filter3_kpi:
                 selected_medicine_kpi = st.selectbox("Item:", options=['All'] + available_medicines, key='medicine_kpi')
 
             # Filter data for KPIs and Charts
-            filtered_data_kpis = final_analysis_df_sequential.copy()
-            if selected_month_kpi != 'All':
-                filtered_data_kpis = filtered_data_kpis[filtered_data_kpis['Forecast Ship Date'].dt.strftime('%Y-%m') == selected_month_kpi]
-            if selected_customer_kpi != 'All':
-                filtered_data_kpis = filtered_data_kpis[filtered_data_kpis['Ship To Customer (Bill To)'] == selected_customer_kpi]
-            if selected_medicine_kpi != 'All':
-                filtered_data_kpis = filtered_data_kpis[filtered_data_kpis['Item Description'] == selected_medicine_kpi]
+            filtered_data_kpis = filter_analysis(
+                final_analysis_df_sequential, selected_month_kpi, selected_customer_kpi, selected_medicine_kpi
+            )
 
             if not filtered_data_kpis.empty:
                 kpi_total_forecasted_qty = filtered_data_kpis['Forecasted Qty'].sum()
                 kpi_total_missing_qty = filtered_data_kpis['Missing Quantity'].sum()
                 
-                kpi_items_fully_covered = filtered_data_kpis[filtered_data_kpis['In Stock Status'] == 'Yes'].shape[0]
-                kpi_total_forecasted_items = filtered_data_kpis.shape[0]
+                kpi_items_fully_covered = int((filtered_data_kpis['In Stock Status'] == 'Yes').sum())  # Count the mask, don't materialise the rows
+                kpi_total_forecasted_items = len(filtered_data_kpis)
                 
                 kpi_percentage_capacity = 0
                 if kpi_total_forecasted_items > 0:
@@ -407,44 +770,6 @@ else: # This means st.session_state.data_loaded is True. Display the tabs.
                 kpi_total_missing_qty = 0
 
 
-            st.markdown(
-                """
-                <style>
-                /* Estilo geral para os containers das métricas (os "cards") */
-                div[data-testid="stMetric"] {
-                    background-color: white; /* Fundo branco para o card */
-                    border-radius: 10px; /* Bordas arredondadas */
-                    padding: 20px; /* Espaçamento interno */
-                    box-shadow: 0 4px 8px rgba(0, 0, 0, 0.1); /* Sombra suave para efeito de card */
-                    margin-bottom: 20px; /* Espaçamento entre os cards e o conteúdo abaixo */
-                }
-
-                /* Estilo para o rótulo (label) da métrica */
-                div[data-testid="stMetric"] label p {
-                    font-family: Arial, sans-serif; /* Fonte do subtítulo da página principal */
-                    color: #5d5d5d ; /* Cor cinza escuro para o rótulo */
-                    font-weight: bold; /* Sem negrito */
-                    font-size: 1em; /* Tamanho da fonte do rótulo */
-                }
-
-                /* Estilo para o valor (value) da métrica */
-                div[data-testid="stMetric"] div[data-testid="stMetricValue"] {
-                    font-family: Verdana, sans-serif; /* Fonte do título da página principal */
-                    color: #a21a5e; /* Cor vinho para o valor */
-                    font-size: 2.5em; /* Aumenta o tamanho do valor para destaque */
-                    font-weight: bold; /* Deixa o valor em negrito */
-                }
-
-                /* Estilo para o delta (se houver um) na métrica */
-                div[data-testid="stMetricDelta"] {
-                    font-family: Arial, sans-serif; /* Fonte consistente */
-                    color: #5d5d5d; /* Cor cinza escuro */
-                    font-size: 1em; /* Tamanho padrão */
-                }
-                </style>
-                """,
-                unsafe_allow_html=True
-            )
             col1_charts, col2_charts = st.columns(2) # Renamed to avoid conflict
             with col1_charts:
                 st.markdown(
@@ -452,25 +777,11 @@ else: # This means st.session_state.data_loaded is True. Display the tabs.
                     unsafe_allow_html=True
                 )
                 if not filtered_data_kpis.empty:
-                    monthly_forecast_chart_data = filtered_data_kpis.groupby(filtered_data_kpis['Forecast Ship Date'].dt.to_period('M'))['Forecasted Qty'].sum().reset_index()
-                    monthly_forecast_chart_data['Month'] = monthly_forecast_chart_data['Forecast Ship Date'].dt.strftime('%b %Y')
+                    # Months stay sorted so the bars read chronologically
+                    monthly_forecast_chart_data = filtered_data_kpis.groupby('Forecast Month', sort=True)['Forecasted Qty'].sum().reset_index()
+                    monthly_forecast_chart_data['Month'] = monthly_forecast_chart_data['Forecast Month'].dt.strftime('%b %Y')
 
-                    fig_px_bar = px.bar(
-                        monthly_forecast_chart_data,
-                        x='Month',
-                        y='Forecasted Qty'
-                    )
-                    fig_px_bar.update_traces(marker_color='#c7c8c9')
-                    fig_px_bar.update_layout(
-                        hoverlabel=dict(
-                            bgcolor="#a21a5e", 
-                            font_size=12,
-                            font_color="#ffffff",
-                            font_family="Arial, sans-serif" 
-                        ),
-                        plot_bgcolor='rgba(0,0,0,0)', 
-                        paper_bgcolor='rgba(0,0,0,0)', 
-                    )
+                    fig_px_bar = make_monthly_bar(monthly_forecast_chart_data[['Month', 'Forecasted Qty']])
                     st.plotly_chart(fig_px_bar, use_container_width=True)
                 else:
                     st.info("No monthly forecast data to display for the selected filters.")
@@ -483,44 +794,7 @@ else: # This means st.session_state.data_loaded is True. Display the tabs.
                 
                 if not filtered_data_kpis.empty and kpi_total_forecasted_qty > 0:
                     pie_total_covered_qty = kpi_total_forecasted_qty - kpi_total_missing_qty
-                    pie_data_chart = pd.DataFrame({
-                        'Category': ['Quantity Covered', 'Quantity Missing'],
-                        'Quantity': [pie_total_covered_qty, kpi_total_missing_qty]
-                    })
-                    fig_pie = px.pie(
-                        pie_data_chart,
-                        values='Quantity',
-                        names='Category',
-                        color='Category',
-                        color_discrete_map={
-                            'Quantity Covered': '#a21a5e',
-                            'Quantity Missing': '#c7c8c9'
-                        }
-                    )
-                    fig_pie.update_traces(
-                        sort=False,
-                        textposition='inside',
-                        textinfo='percent+label',
-                    )
-                    fig_pie.update_layout(
-                        plot_bgcolor='rgba(0,0,0,0)',
-                        paper_bgcolor='rgba(0,0,0,0)',
-                        hoverlabel=dict(
-                            bgcolor="#a21a5e",
-                            font_size=12,
-                            font_color="white",
-                            font_family="Verdana, Geneva, sans-serif"
-                        ),
-                        showlegend=True,
-                        legend_title_text='Status',
-                        legend=dict(
-                            orientation="h",
-                            yanchor="bottom",
-                            y=1.02,
-                            xanchor="right",
-                            x=1
-                        )
-                    )
+                    fig_pie = make_sufficiency_pie(pie_total_covered_qty, kpi_total_missing_qty)
                     st.plotly_chart(fig_pie, use_container_width=True)
                 else:
                     st.info("No stock sufficiency data to display for the selected filters.")
@@ -543,61 +817,4 @@ else: # This means st.session_state.data_loaded is True. Display the tabs.
                 unsafe_allow_html=True
             )
 
-            # --- Filters for Hierarchical View ---
-            col_filter1_hier, col_filter2_hier, col_filter3_hier = st.columns(3)
-            with col_filter1_hier:
-                selected_month_hier = st.selectbox("Month (YYYY-MM):", options=['All'] + available_months, key='month_hier')
-            with col_filter2_hier:
-                selected_customer_hier = st.selectbox("Customer:", options=['All'] + available_customers, key='customer_hier')
-            with col_filter3_hier:
-                selected_medicine_hier = st.selectbox("Item:", options=['All'] + available_medicines, key='medicine_hier')
-
-            # Filter data for the hierarchical view
-            filtered_data_hierarchical = final_analysis_df_sequential.copy()
-            if selected_month_hier != 'All':
-                filtered_data_hierarchical = filtered_data_hierarchical[filtered_data_hierarchical['Forecast Ship Date'].dt.strftime('%Y-%m') == selected_month_hier]
-            if selected_customer_hier != 'All':
-                filtered_data_hierarchical = filtered_data_hierarchical[filtered_data_hierarchical['Ship To Customer (Bill To)'] == selected_customer_hier]
-            if selected_medicine_hier != 'All':
-                filtered_data_hierarchical = filtered_data_hierarchical[filtered_data_hierarchical['Item Description'] == selected_medicine_hier]
-
-            if not filtered_data_hierarchical.empty:
-                # Prepare data for display (similar to matrix tab, but used within expanders)
-                # Ensure 'Required Expiration Date (Customer)' is calculated for the filtered data
-                filtered_data_hierarchical['Required Expiration Date (Customer)'] = filtered_data_hierarchical.apply(
-                    lambda row: row['Forecast Ship Date'] + pd.DateOffset(months=row['Min Shelf-Life (Months)']), axis=1
-                )
-                # Format dates for display
-                display_df_hierarchical = filtered_data_hierarchical.copy()
-                display_df_hierarchical['Forecast Ship Date'] = display_df_hierarchical['Forecast Ship Date'].dt.strftime('%Y-%m-%d')
-                display_df_hierarchical['Expiration Date (Stock)'] = display_df_hierarchical['Expiration Date (Stock)'].dt.strftime('%Y-%m-%d').replace({pd.NaT: 'N/A'})
-                display_df_hierarchical['Required Expiration Date (Customer)'] = display_df_hierarchical['Required Expiration Date (Customer)'].dt.strftime('%Y-%m-%d')
-
-                for product in display_df_hierarchical['Item Description'].unique():
-                    product_df_hier = display_df_hierarchical[display_df_hierarchical['Item Description'] == product]
-                    
-                    product_total_forecasted = product_df_hier['Forecasted Qty'].sum() # Use original Qty for sum
-                    product_total_missing = product_df_hier['Missing Quantity'].sum()
-
-                    with st.expander(f"**Product:** {product} (Total Forecasted: {product_total_forecasted:,.0f} | Missing: {product_total_missing:,.0f})"):
-                        st.markdown(f"**Customer Details for {product}:**")
-                        for customer in product_df_hier['Ship To Customer (Bill To)'].unique():
-                            customer_df_hier = product_df_hier[product_df_hier['Ship To Customer (Bill To)'] == customer]
-                            
-                            customer_shelf_life = customer_df_hier['Min Shelf-Life (Months)'].iloc[0] if not customer_df_hier.empty else 'N/A'
-                            customer_total_forecasted = customer_df_hier['Forecasted Qty'].sum()
-                            customer_total_missing = customer_df_hier['Missing Quantity'].sum()
-
-                            st.markdown(f"**Customer:** {customer} | Req. Shelf-life: {customer_shelf_life} months (Forecasted: {customer_total_forecasted:,.0f} | Missing: {customer_total_missing:,.0f})")
-                            st.dataframe(customer_df_hier[[
-                                'Forecast Ship Date',
-                                'Forecasted Qty',
-                                'Available Stock Quantity (Initial)',
-                                'Remaining Stock After Order',
-                                'Expiration Date (Stock)',
-                                'Required Expiration Date (Customer)',
-                                'In Stock Status',
-                                'Missing Quantity'
-                            ]].reset_index(drop=True), use_container_width=True)
-            else:
-                st.info("No data to display for the selected filters in the Hierarchical View.")
+            render_hierarchical_view(final_analysis_df_sequential, available_months, available_customers, available_medicines)